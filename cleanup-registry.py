@@ -1,13 +1,28 @@
 #!/usr/bin/env python3
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import logging
-import builtins
-from datetime import datetime, timedelta
+import logging.handlers
+import re
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from email.utils import parsedate_to_datetime
+from functools import lru_cache
+import sqlite3
 import subprocess
 import sys
 import os
+import threading
+from collections import deque
+from contextlib import closing
+from urllib.parse import urljoin
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 def load_config(config_file='config.json'):
     """Load configuration settings from a JSON file."""
@@ -20,16 +35,41 @@ config = load_config()
 REGISTRY_URL = config['registry']['url']
 REGISTRY_USER = config['registry']['user']
 REGISTRY_PASSWORD = config['registry']['password']
+AUTH = (REGISTRY_USER, REGISTRY_PASSWORD) if REGISTRY_USER and REGISTRY_PASSWORD else None
 REGISTRY_CONTAINER = config['registry']['container']
+MAX_WORKERS = config['registry'].get('max_workers', 8)
 DAYS_TO_KEEP = config['cleanup']['days_to_keep']
-PROTECTED_TAGS = config['cleanup']['protected_tags']
+PROTECTED_TAGS = frozenset(config['cleanup']['protected_tags'])
+SPECIAL_TAGS = frozenset({'buildcache', 'latest', 'cache'})
+SKIP_TAGS = PROTECTED_TAGS | SPECIAL_TAGS
 PROTECTED_PATTERNS = config['cleanup'].get('protected_patterns', [])
+PROTECTED_RE = (
+    re.compile('|'.join(map(re.escape, PROTECTED_PATTERNS)), re.IGNORECASE)
+    if PROTECTED_PATTERNS else None
+)
 PATHS_CONFIG = config['paths']
 CONFIG_PATH = PATHS_CONFIG['config']
 REGISTRY_STORAGE_PATH = PATHS_CONFIG.get('storage', '/var/lib/registry')
+HOST_STORAGE_DEDICATED = PATHS_CONFIG.get('host_storage_dedicated', False)
+CACHE_PATH = PATHS_CONFIG.get('cache', 'cache.db')
+CACHE_SCHEMA_VERSION = 4
 DEBUG = os.getenv('DEBUG', 'false').lower() == 'true'
 LOG_FILE_PATH = '/var/logs/clean-registry.log'
-ORIGINAL_PRINT = builtins.print
+PAGE_SIZE = 1000
+MANIFEST_TYPES = [
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.docker.distribution.manifest.v1+json',
+]
+MANIFEST_LIST_TYPES = [
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+]
+SEPARATOR = '=' * 50
+SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB', 'PB')
+DATE_FORMAT = '%Y-%m-%d %H:%M'
+FRACTION_RE = re.compile(r'\.(\d+)')
+CREATED_ANNOTATION = 'org.opencontainers.image.created'
 
 
 def setup_logging():
@@ -37,6 +77,10 @@ def setup_logging():
     logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
 
     if not logger.handlers:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(console_handler)
+
         formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
         try:
             log_dir = os.path.dirname(LOG_FILE_PATH)
@@ -44,203 +88,453 @@ def setup_logging():
                 os.makedirs(log_dir, exist_ok=True)
             file_handler = logging.FileHandler(LOG_FILE_PATH)
         except OSError as exc:
-            ORIGINAL_PRINT(f"Warning: unable to set up log file {LOG_FILE_PATH}: {exc}")
+            logger.warning("Unable to set up log file %s: %s", LOG_FILE_PATH, exc)
         else:
             file_handler.setFormatter(formatter)
             file_handler.setLevel(logging.DEBUG if DEBUG else logging.INFO)
-            logger.addHandler(file_handler)
-
-    if not logger.handlers:
-        logger.addHandler(logging.NullHandler())
+            # Batch file writes; errors and interpreter exit flush the buffer
+            memory_handler = logging.handlers.MemoryHandler(
+                1024, flushLevel=logging.ERROR, target=file_handler
+            )
+            logger.addHandler(memory_handler)
 
     return logger
 
 
 LOGGER = setup_logging()
 
-
-def _log_print(*args, **kwargs):
-    # Mirror stdout to the log file while preserving original behavior.
-    message = kwargs.get('sep', ' ').join(str(arg) for arg in args)
-    end = kwargs.get('end', '\n')
-    if end is not None and end != '\n':
-        message = f"{message}{end}"
-
-    if LOGGER:
-        LOGGER.log(logging.DEBUG if DEBUG else logging.INFO, message)
-
-    ORIGINAL_PRINT(*args, **kwargs)
-
-
-builtins.print = _log_print
-
-def get_auth():
-    """Return the basic-auth credentials tuple if available."""
-    if REGISTRY_USER and REGISTRY_PASSWORD:
-        return (REGISTRY_USER, REGISTRY_PASSWORD)
-    return None
+def create_session():
+    """Build a shared HTTP session that keeps registry connections alive."""
+    session = requests.Session()
+    session.auth = AUTH
+    # One pooled connection per worker thread, so none are opened and discarded
+    adapter = HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=MAX_WORKERS,
+        # Hand back the last response once retries run out, rather than raising
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504), raise_on_status=False)
+    )
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+SESSION = create_session()
+# Set once the registry rejects the credentials, so queued lookups stop early
+AUTH_REJECTED = threading.Event()
+
+def _loads(data):
+    """Decode a JSON document, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _json(response):
+    """Decode a JSON response body."""
+    return _loads(response.content)
+
+def _check_auth(response):
+    """Raise when the registry rejects the credentials.
+
+    Every request uses the same credentials, so carrying on would only report
+    each remaining tag as missing; later requests are refused up front. A 403
+    may be scoped to one repository, and errors from storage that a blob was
+    redirected to say nothing about the credentials, so neither counts.
+    """
+    if response.status_code == 401 and not response.history:
+        AUTH_REJECTED.set()
+        response.raise_for_status()
+
+def _ensure_auth():
+    """Refuse to send another request once the credentials have been rejected."""
+    if AUTH_REJECTED.is_set():
+        raise requests.HTTPError("Registry rejected the credentials")
+
+def _negotiate(send, media_types, headers=None):
+    """Request a manifest with ``send(headers)``, which returns ``(response, body)``.
+
+    All ``media_types`` are offered at once; registries that answer such a
+    combined Accept header with 406 Not Acceptable get one type at a time.
+    """
+    headers = dict(headers or {}, Accept=', '.join(media_types))
+    response, body = send(headers)
+    for media_type in media_types:
+        if response.status_code != 406:
+            break
+        headers['Accept'] = media_type
+        response, body = send(headers)
+    return response, body
+
+def _get_body(url, headers=None):
+    """GET a document and return ``(response, body)`` with the connection released.
+
+    The body is read straight from the socket rather than through
+    ``response.content``, and is None unless the request succeeded.
+    """
+    _ensure_auth()
+    with SESSION.get(url, headers=headers, stream=True) as response:
+        _check_auth(response)
+        if response.status_code != 200:
+            return response, None
+        response.raw.decode_content = True
+        return response, response.raw.read()
+
+def _get_paginated(url, key):
+    """Collect a list from a paginated endpoint by following its Link headers."""
+    items = []
+    while url:
+        response = SESSION.get(url)
+        response.raise_for_status()
+        items.extend(_json(response).get(key) or [])
+        next_url = response.links.get('next', {}).get('url')
+        url = urljoin(response.url, next_url) if next_url else None
+    return items
 
 def get_repositories():
     """Retrieve the list of all repositories."""
-    url = f"{REGISTRY_URL}/v2/_catalog"
-    response = requests.get(url, auth=get_auth())
-    response.raise_for_status()
-    return response.json().get('repositories', [])
+    return _get_paginated(f"{REGISTRY_URL}/v2/_catalog?n={PAGE_SIZE}", 'repositories')
 
 def get_tags(repository):
     """Retrieve the list of tags for a repository."""
-    url = f"{REGISTRY_URL}/v2/{repository}/tags/list"
-    response = requests.get(url, auth=get_auth())
-    response.raise_for_status()
-    return response.json().get('tags', [])
+    return _get_paginated(f"{REGISTRY_URL}/v2/{repository}/tags/list?n={PAGE_SIZE}", 'tags')
+
+def _parse_timestamp(value):
+    """Parse an RFC 3339 timestamp from an image config into an aware datetime."""
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    # Go emits up to nine fraction digits with trailing zeros dropped, while
+    # fromisoformat before Python 3.11 only takes exactly three or six
+    value = FRACTION_RE.sub(lambda match: '.' + match.group(1)[:6].ljust(6, '0'), value, count=1)
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+@lru_cache(maxsize=4096)
+def _fetch_config_created(repository, config_digest):
+    """Return the creation timestamp string from an image config blob.
+
+    Only the timestamp is kept, so tags sharing a config reuse the cached
+    value without holding the whole parsed blob in memory.
+    """
+    _, content = _get_body(f"{REGISTRY_URL}/v2/{repository}/blobs/{config_digest}")
+    if content is None:
+        return None
+    config = _loads(content)
+    
+    LOGGER.debug("    DEBUG: Config keys: %s", list(config))
+    
+    # Check various fields that may contain the date
+    created_str = config.get('created')
+    if created_str:
+        return created_str
+    
+    # Fall back to history entries
+    for hist in config.get('history', []):
+        if 'created' in hist:
+            return hist['created']
+    
+    return None
 
-def get_image_created_date(repository, tag):
-    """Get the image creation date from the config blob or manifest."""
+def _head_manifest(repository, reference, etag=None):
+    """Issue a HEAD request for a manifest to read its digest without the body.
+
+    With ``etag`` the request is conditional and an unchanged manifest is
+    answered with 304 Not Modified.
+    """
+    _ensure_auth()
+    url = f"{REGISTRY_URL}/v2/{repository}/manifests/{reference}"
+    headers = {'If-None-Match': etag} if etag else None
+    response, _ = _negotiate(
+        lambda headers: (SESSION.head(url, headers=headers), None),
+        MANIFEST_TYPES + MANIFEST_LIST_TYPES,
+        headers
+    )
+    _check_auth(response)
+    return response
+
+def _resolve_tag_head(repository, tag, cutoff_date, cached=None):
+    """Find the manifest a tag points at with a HEAD request.
+
+    Returns ``(digest, created_date, etag)`` where ``created_date`` is only set
+    when it could be taken from ``cached``, a tuple of the same shape from a
+    previous run, or from a Last-Modified header newer than ``cutoff_date``. A
+    cached date newer than ``cutoff_date`` is reused without any request;
+    otherwise it is reused as long as the tag still points at the same manifest.
+    """
     try:
-        url = f"{REGISTRY_URL}/v2/{repository}/manifests/{tag}"
+        etag = None
+        if cached:
+            cached_digest, cached_date, etag = cached
+            # A tag known to be recent is kept without asking the registry
+            if cached_date >= cutoff_date:
+                return cached
         
-        manifest_types = [
-            'application/vnd.oci.image.manifest.v1+json',
-            'application/vnd.docker.distribution.manifest.v2+json',
-            'application/vnd.docker.distribution.manifest.v1+json',
-        ]
+        response = _head_manifest(repository, tag, etag)
+        if response.status_code == 304:
+            LOGGER.debug("    DEBUG: Using cached date for %s", tag)
+            return cached
+        if response.status_code != 200:
+            return None, None, None
         
-        manifest = None
-        digest = None
-        response = None
+        digest = response.headers.get('Docker-Content-Digest')
+        if cached and digest == cached_digest:
+            LOGGER.debug("    DEBUG: Using cached date for %s", tag)
+            return cached
         
-        for media_type in manifest_types:
-            headers = {'Accept': media_type}
-            response = requests.get(url, headers=headers, auth=get_auth())
-            
-            if response.status_code == 404:
-                return None, None
-            
-            if response.status_code == 200:
-                digest = response.headers.get('Docker-Content-Digest')
-                manifest = response.json()
-                if DEBUG:
-                    print(f"    DEBUG: Got manifest type: {media_type}")
-                break
+        # Last-Modified is the push time, which is never earlier than the build
+        # time, so a recent value keeps the tag without fetching the manifest
+        created_date = None
+        last_modified = response.headers.get('Last-Modified')
+        if last_modified:
+            last_modified_date = parsedate_to_datetime(last_modified)
+            if last_modified_date >= cutoff_date:
+                LOGGER.debug("    DEBUG: Using Last-Modified: %s", last_modified)
+                created_date = last_modified_date
+        return digest, created_date, response.headers.get('ETag')
         
-        if manifest is None:
-            return None, None
+    except requests.HTTPError:
+        raise
+    except Exception:
+        # The tag is reported as skipped; the traceback only matters when debugging
+        LOGGER.debug("    DEBUG: Manifest lookup failed for %s:%s", repository, tag, exc_info=True)
+        return None, None, None
+
+def get_image_created_date(repository, digest):
+    """Get the image date from the manifest history, the config blob or its headers.
+
+    Recently pushed manifests are already settled by the tag HEAD, so an old
+    Last-Modified date is only used when nothing better is known.
+    """
+    try:
+        url = f"{REGISTRY_URL}/v2/{repository}/manifests/{digest}"
+        response, body = _negotiate(
+            lambda headers: _get_body(url, headers),
+            MANIFEST_TYPES + MANIFEST_LIST_TYPES
+        )
+        
+        if body is None:
+            return None
+        
+        manifest = _loads(body)
+        media_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        if not media_type:
+            media_type = manifest.get('mediaType')
+        LOGGER.debug("    DEBUG: Got manifest type: %s", media_type)
+        
+        # Method 1: schema1 manifests embed the date in v1 compatibility data
+        for history_entry in manifest.get('history', []):
+            if 'v1Compatibility' in history_entry:
+                v1_compat = _loads(history_entry['v1Compatibility'])
+                created_str = v1_compat.get('created')
+                if created_str:
+                    return _parse_timestamp(created_str)
         
         # Handle manifest lists (multi-arch)
-        if manifest.get('mediaType') in [
-            'application/vnd.docker.distribution.manifest.list.v2+json',
-            'application/vnd.oci.image.index.v1+json'
-        ]:
+        if media_type in MANIFEST_LIST_TYPES:
+            # BuildKit annotates OCI indexes with the build date, which saves
+            # fetching a child manifest and its config
+            created_str = (manifest.get('annotations') or {}).get(CREATED_ANNOTATION)
+            if created_str:
+                return _parse_timestamp(created_str)
             if 'manifests' in manifest and len(manifest['manifests']) > 0:
                 first_manifest_digest = manifest['manifests'][0]['digest']
-                response = requests.get(
-                    f"{REGISTRY_URL}/v2/{repository}/manifests/{first_manifest_digest}",
-                    headers={'Accept': 'application/vnd.oci.image.manifest.v1+json'},
-                    auth=get_auth()
-                )
-                if response.status_code == 200:
-                    manifest = response.json()
+                child_url = f"{REGISTRY_URL}/v2/{repository}/manifests/{first_manifest_digest}"
+                _, body = _negotiate(lambda headers: _get_body(child_url, headers), MANIFEST_TYPES)
+                if body is not None:
+                    manifest = _loads(body)
         
-        # Method 1: use the config blob for the date
+        # Method 2: fall back to the config blob, which costs another request
         if 'config' in manifest:
             config_digest = manifest['config']['digest']
-            config_url = f"{REGISTRY_URL}/v2/{repository}/blobs/{config_digest}"
-            config_response = requests.get(config_url, auth=get_auth())
-            
-            if config_response.status_code == 200:
-                config = config_response.json()
-                
-                if DEBUG:
-                    print(f"    DEBUG: Config keys: {list(config.keys())}")
-                
-                # Check various fields that may contain the date
-                created_str = config.get('created')
-                if created_str:
-                    created_date = datetime.fromisoformat(created_str.replace('Z', '+00:00'))
-                    return digest, created_date.replace(tzinfo=None)
-                
-                # Fall back to history entries
-                if 'history' in config and len(config['history']) > 0:
-                    for hist in config['history']:
-                        if 'created' in hist:
-                            created_str = hist['created']
-                            created_date = datetime.fromisoformat(created_str.replace('Z', '+00:00'))
-                            return digest, created_date.replace(tzinfo=None)
+            created_str = _fetch_config_created(repository, config_digest)
+            if created_str:
+                return _parse_timestamp(created_str)
+        
+        # Method 3: settle for the push time when nothing better is known
+        last_modified = response.headers.get('Last-Modified')
+        if last_modified:
+            LOGGER.debug("    DEBUG: Using Last-Modified: %s", last_modified)
+            return parsedate_to_datetime(last_modified)
         
-        # Method 2: fall back to Last-Modified on the manifest
-        if response:
-            last_modified = response.headers.get('Last-Modified')
-            if last_modified:
-                if DEBUG:
-                    print(f"    DEBUG: Using Last-Modified: {last_modified}")
-                date = parsedate_to_datetime(last_modified)
-                return digest, date.replace(tzinfo=None)
+        return None
         
-        # Method 3: check v1 compatibility data
-        if 'history' in manifest:
-            for history_entry in manifest.get('history', []):
-                if 'v1Compatibility' in history_entry:
-                    v1_compat = json.loads(history_entry['v1Compatibility'])
-                    created_str = v1_compat.get('created')
-                    if created_str:
-                        created_date = datetime.fromisoformat(created_str.replace('Z', '+00:00'))
-                        return digest, created_date.replace(tzinfo=None)
+    except requests.HTTPError:
+        raise
+    except Exception:
+        LOGGER.debug("    DEBUG: Manifest fetch failed for %s@%s", repository, digest, exc_info=True)
+        return None
+
+def _tag_digest(repository, tag):
+    """Return the manifest digest a tag points at, or None if the tag is gone.
+
+    Any other failure raises, since the image the tag refers to is unknown.
+    """
+    response = _head_manifest(repository, tag)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    digest = response.headers.get('Docker-Content-Digest')
+    if not digest:
+        raise requests.HTTPError(f"No digest returned for {repository}:{tag}", response=response)
+    return digest
+
+def _manifest_children(repository, digest):
+    """Return the digests a manifest list refers to, or an empty tuple for an image.
+
+    Any failure raises, since the images a kept list needs would be unknown.
+    """
+    url = f"{REGISTRY_URL}/v2/{repository}/manifests/{digest}"
+    response, body = _negotiate(lambda headers: _get_body(url, headers), MANIFEST_TYPES + MANIFEST_LIST_TYPES)
+    if response.status_code == 404:
+        return ()
+    if body is None:
+        raise requests.HTTPError(f"Unable to fetch manifest {repository}@{digest}: {response.status_code}", response=response)
+    return tuple(child['digest'] for child in _loads(body).get('manifests', []))
+
+def _is_candidate(tag):
+    """Tell whether a tag is subject to the age check, i.e. not protected or special."""
+    # Most tags are neither protected nor special, so settle them with one set
+    # lookup before trying the patterns
+    return tag not in SKIP_TAGS and not (PROTECTED_RE and PROTECTED_RE.search(tag))
+
+def resolve_tags(executor, repository, tags, cutoff_date, tag_cache):
+    """Start resolving ``(digest, created_date, etag)`` for each of a repository's tags.
+
+    Returns one future per tag without waiting for any of them. Each tag first
+    sends a HEAD to learn its digest, reusing cached dates where possible; as
+    soon as that leaves the date unknown, the manifest and config lookup for
+    the digest is queued. Lookups are shared per unique digest, so aliased
+    tags cost a single one, and no tag waits for the rest of its repository.
+    """
+    date_futures = {}
+    lock = threading.Lock()
+    
+    def lookup_date(digest):
+        with lock:
+            if digest not in date_futures:
+                date_futures[digest] = executor.submit(get_image_created_date, repository, digest)
+            return date_futures[digest]
+    
+    def resolve(tag):
+        result = Future()
         
-        return digest, None
+        def on_head(head_future):
+            if head_future.exception() is not None:
+                result.set_exception(head_future.exception())
+                return
+            digest, created_date, etag = head_future.result()
+            if digest is None or created_date is not None:
+                result.set_result((digest, created_date, etag))
+                return
+            
+            def on_date(date_future):
+                if date_future.exception() is not None:
+                    result.set_exception(date_future.exception())
+                else:
+                    result.set_result((digest, date_future.result(), etag))
+            
+            lookup_date(digest).add_done_callback(on_date)
         
-    except Exception as e:
-        if DEBUG:
-            print(f"    DEBUG Error: {e}")
-            import traceback
-            traceback.print_exc()
-        return None, None
+        cached = tag_cache.get((repository, tag))
+        executor.submit(_resolve_tag_head, repository, tag, cutoff_date, cached).add_done_callback(on_head)
+        return result
+    
+    return [resolve(tag) for tag in tags]
 
 def delete_tag(repository, digest):
     """Delete a tag by its manifest digest."""
     url = f"{REGISTRY_URL}/v2/{repository}/manifests/{digest}"
-    response = requests.delete(url, auth=get_auth())
+    try:
+        response = SESSION.delete(url)
+    except requests.RequestException:
+        LOGGER.debug("    DEBUG: Delete failed for %s@%s", repository, digest, exc_info=True)
+        return False
     if response.status_code == 202:
         return True
     return False
 
+def _open_cache():
+    """Open the tag cache database, recreating it if the schema is outdated."""
+    conn = sqlite3.connect(CACHE_PATH)
+    if conn.execute('PRAGMA user_version').fetchone()[0] != CACHE_SCHEMA_VERSION:
+        conn.execute('DROP TABLE IF EXISTS tags')
+        conn.execute(
+            'CREATE TABLE tags (repo TEXT, tag TEXT, digest TEXT, created_ts INTEGER, '
+            'etag TEXT, PRIMARY KEY (repo, tag))'
+        )
+        conn.execute(f'PRAGMA user_version = {CACHE_SCHEMA_VERSION}')
+        conn.commit()
+    return conn
+
+def load_tag_cache():
+    """Load cached (digest, created date, etag) tuples keyed by (repository, tag)."""
+    try:
+        with closing(_open_cache()) as conn:
+            rows = conn.execute('SELECT repo, tag, digest, created_ts, etag FROM tags').fetchall()
+    except sqlite3.Error as exc:
+        LOGGER.warning("Failed to load tag cache %s: %s", CACHE_PATH, exc)
+        return {}
+    
+    return {
+        (repo, tag): (digest, datetime.fromtimestamp(created_ts, timezone.utc), etag)
+        for repo, tag, digest, created_ts, etag in rows
+    }
+
+def save_tag_cache(entries):
+    """Replace the tag cache with the entries seen during this run."""
+    try:
+        with closing(_open_cache()) as conn, conn:
+            # Tags that disappeared or were deleted drop out of the cache here
+            conn.execute('DELETE FROM tags')
+            conn.executemany(
+                'INSERT INTO tags (repo, tag, digest, created_ts, etag) VALUES (?, ?, ?, ?, ?)',
+                [
+                    (repo, tag, digest, int(created.timestamp()), etag)
+                    for (repo, tag), (digest, created, etag) in entries.items()
+                ]
+            )
+    except sqlite3.Error as exc:
+        LOGGER.warning("Failed to save tag cache %s: %s", CACHE_PATH, exc)
+
 def format_size(num_bytes):
     """Convert a byte count into a human-readable string."""
     if num_bytes is None:
         return "unknown"
 
-    step = 1024.0
-    units = ['B', 'KB', 'MB', 'GB', 'TB', 'PB']
-    size = float(num_bytes)
+    if num_bytes < 1024:
+        return f"{int(num_bytes)} B"
 
-    for unit in units:
-        if size < step or unit == units[-1]:
-            if unit == 'B':
-                return f"{int(size)} {unit}"
-            return f"{size:.2f} {unit}"
-        size /= step
+    num_bytes = int(num_bytes)
+    # Each unit is 10 bits wide, so the bit length picks the unit directly
+    index = min((num_bytes.bit_length() - 1) // 10, len(SIZE_UNITS) - 1)
+    return f"{num_bytes / (1 << (index * 10)):.2f} {SIZE_UNITS[index]}"
 
-    return f"{size:.2f} PB"
+def _directory_size(path):
+    """Return the apparent size of a directory tree, like ``du -sb``."""
+    total = 0
+    with os.scandir(path) as entries:
+        for entry in entries:
+            total += entry.stat(follow_symlinks=False).st_size
+            if entry.is_dir(follow_symlinks=False):
+                total += _directory_size(entry.path)
+    return total
 
 def get_registry_disk_usage():
     """Return the registry storage size in bytes, if available."""
     host_storage_path = PATHS_CONFIG.get('host_storage')
     if host_storage_path and os.path.exists(host_storage_path):
         try:
-            result = subprocess.run(
-                ['du', '-sb', host_storage_path],
-                capture_output=True,
-                text=True,
-                check=True,
-                timeout=30
-            )
-            size_str = result.stdout.strip().split()[0]
-            size = int(size_str)
-            LOGGER.info(f"Registry storage size (host path): {format_size(size)}")
+            if HOST_STORAGE_DEDICATED:
+                # The volume holds only registry data, so filesystem usage is enough
+                stat = os.statvfs(host_storage_path)
+                size = (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+            else:
+                size = _directory_size(host_storage_path)
+            LOGGER.debug("Registry storage size (host path): %s", format_size(size))
             return size
-        except (subprocess.CalledProcessError, subprocess.TimeoutExpired, ValueError, IndexError) as exc:
-            LOGGER.warning(f"Failed to get size via host path {host_storage_path}: {exc}")
-            if DEBUG:
-                print(f"  DEBUG: Host path measurement failed: {exc}")
+        except OSError as exc:
+            LOGGER.warning("Failed to get size via host path %s: %s", host_storage_path, exc)
     
     try:
         check_cmd = ['docker', 'inspect', '-f', '{{.State.Running}}', REGISTRY_CONTAINER]
@@ -252,21 +546,21 @@ def get_registry_disk_usage():
         )
         
         if check_result.returncode != 0:
-            LOGGER.error(f"Container {REGISTRY_CONTAINER} not found or not accessible")
-            print(f"Error: Container {REGISTRY_CONTAINER} not found")
+            LOGGER.error("Container %s not found or not accessible", REGISTRY_CONTAINER)
             return None
         
         is_running = check_result.stdout.strip()
         if is_running != 'true':
-            LOGGER.error(f"Container {REGISTRY_CONTAINER} is not running")
-            print(f"Error: Container {REGISTRY_CONTAINER} is not running")
+            LOGGER.error("Container %s is not running", REGISTRY_CONTAINER)
             return None
         
         du_cmd = ['docker', 'exec', REGISTRY_CONTAINER, 'du', '-sb', REGISTRY_STORAGE_PATH]
+        # Only the "<bytes>\t<path>" line matters: keep it as raw bytes and
+        # drop stderr so permission warnings are not buffered
         result = subprocess.run(
             du_cmd,
-            capture_output=True,
-            text=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
             check=True,
             timeout=60
         )
@@ -276,25 +570,21 @@ def get_registry_disk_usage():
             LOGGER.warning("du command returned empty output")
             return None
         
-        size_str = output.split()[0]
-        size = int(size_str)
-        LOGGER.info(f"Registry storage size (container): {format_size(size)}")
+        size = int(output.split(b'\t', 1)[0])
+        LOGGER.debug("Registry storage size (container): %s", format_size(size))
         return size
         
     except subprocess.TimeoutExpired:
         LOGGER.error("Timeout while measuring registry storage size")
-        print("Error: Timeout while measuring storage size")
         return None
     except subprocess.CalledProcessError as exc:
-        LOGGER.error(f"Failed to execute du in container: {exc.stderr if exc.stderr else exc}")
-        print(f"Error: Failed to measure storage size")
+        LOGGER.error("Failed to execute du in container: %s", exc.stderr or exc)
         return None
     except (ValueError, IndexError) as exc:
-        LOGGER.error(f"Failed to parse du output: {exc}")
+        LOGGER.error("Failed to parse du output: %s", exc)
         return None
-    except Exception as exc:
+    except Exception:
         LOGGER.exception("Unexpected error measuring registry storage")
-        print(f"Error: {exc}")
         return None
 
 
@@ -307,128 +597,210 @@ def run_garbage_collection_docker(dry_run=False):
     
     try:
         LOGGER.debug("Executing garbage collection command: %s", ' '.join(cmd))
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.stdout and DEBUG:
-            LOGGER.debug("Garbage collector stdout:\n%s", result.stdout.strip())
-        if result.stderr:
-            LOGGER.warning("Garbage collector stderr: %s", result.stderr.strip())
-
-        if result.returncode != 0:
-            LOGGER.error("Garbage collection exited with code %s", result.returncode)
+        # GC prints a line per blob, so stream its output instead of buffering
+        # it all; only the last lines are kept to explain a failure
+        tail = deque(maxlen=20)
+        with subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1
+        ) as proc:
+            for line in proc.stdout:
+                line = line.rstrip()
+                tail.append(line)
+                LOGGER.debug("Garbage collector: %s", line)
+
+        if proc.returncode != 0:
+            LOGGER.error("Garbage collection exited with code %s", proc.returncode)
+            if tail:
+                LOGGER.error("Garbage collector output (last lines):\n%s", '\n'.join(tail))
         else:
-            LOGGER.info("Garbage collection command completed successfully")
+            LOGGER.debug("Garbage collection command completed successfully")
 
-        return result.returncode == 0
-    except Exception as e:
+        return proc.returncode == 0
+    except Exception:
         LOGGER.exception("Error running garbage collection")
-        print(f"Error running garbage collection: {e}")
         return False
 
 def main():
-    print(f"Starting Docker Registry cleanup...")
-    print(f"Registry: {REGISTRY_URL}")
-    print(f"Protected tags: {', '.join(PROTECTED_TAGS)}")
-    print(f"Deleting tags older than {DAYS_TO_KEEP} days")
+    LOGGER.info("Starting Docker Registry cleanup...")
+    LOGGER.info("Registry: %s", REGISTRY_URL)
+    LOGGER.info("Protected tags: %s", ', '.join(sorted(PROTECTED_TAGS)))
+    now = datetime.now(timezone.utc)
+    cutoff_date = now - timedelta(days=DAYS_TO_KEEP)
+    LOGGER.info("Deleting tags older than %s days (before %s)", DAYS_TO_KEEP, cutoff_date.strftime(DATE_FORMAT))
     if DEBUG:
-        print(f"Debug mode: ON\n")
+        LOGGER.info("Debug mode: ON\n")
     else:
-        print()
+        LOGGER.info("")
 
 
     deleted_count = 0
     skipped_count = 0
-    before_usage = get_registry_disk_usage()
-    if before_usage is not None:
-        print(f"Registry storage size before cleanup: {format_size(before_usage)} ({before_usage} bytes)")
-    else:
-        print("Registry storage size before cleanup: unavailable")
+    # Measuring storage can walk the whole blob tree, so run it alongside the
+    # registry scan; deletes wait for it to keep the baseline accurate
+    measurement = ThreadPoolExecutor(max_workers=1)
+    before_future = measurement.submit(get_registry_disk_usage)
+    measurement.shutdown(wait=False)
 
-    cutoff_date = datetime.now() - timedelta(days=DAYS_TO_KEEP)
-    
     try:
         repositories = get_repositories()
-        print(f"Found {len(repositories)} repositories\n")
+        LOGGER.info("Found %s repositories\n", len(repositories))
         
-        for repo in repositories:
-            print(f"\nProcessing repository: {repo}")
-            tags = get_tags(repo)
-            
-            if not tags:
-                print(f"  No tags found")
-                continue
-            
-            print(f"  Found {len(tags)} tags")
-            
-            for tag in tags:
-                tag_lower = tag.lower()
-
-                # Skip protected tags
-                if tag in PROTECTED_TAGS:
-                    print(f"  ✓ Keeping protected tag: {tag}")
-                    continue
+        tag_cache = load_tag_cache()
+        seen_tags = {}
+        pending_deletes = []
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            # Tag listing and manifest lookups are network-bound, so fan them out
+            # and queue every repository's lookups before reporting on the first
+            scans = []
+            for repo, tags in zip(repositories, executor.map(get_tags, repositories)):
+                candidates = []
+                skipped_tags = []
+                for tag in tags:
+                    if _is_candidate(tag):
+                        candidates.append(tag)
+                    else:
+                        skipped_tags.append(tag)
+                results = resolve_tags(executor, repo, candidates, cutoff_date, tag_cache)
+                scans.append((repo, tags, candidates, skipped_tags, results))
             
-                if any(pattern in tag_lower for pattern in PROTECTED_PATTERNS):
-                    print(f" ✓ Keeping protected tag: {tag} - pattern match")
-                    continue
-
-                # Skip special tags
-                if tag in ['buildcache', 'latest', 'cache']:
-                    print(f"  ⊘ Skipping special tag: {tag}")
-                    skipped_count += 1
+            for repo, tags, candidates, skipped_tags, results in scans:
+                LOGGER.info("\nProcessing repository: %s", repo)
+                
+                if not tags:
+                    LOGGER.info("  No tags found")
                     continue
                 
-                digest, created_date = get_image_created_date(repo, tag)
+                LOGGER.info("  Found %s tags", len(tags))
                 
-                if digest is None:
-                    print(f"  ! Skipping tag (not found): {tag}")
-                    skipped_count += 1
-                    continue
+                for tag in skipped_tags:
+                    # Skip protected tags
+                    if tag in PROTECTED_TAGS:
+                        LOGGER.info("  ✓ Keeping protected tag: %s", tag)
+                        continue
                 
-                if created_date is None:
-                    print(f"  ! Skipping tag (no date info): {tag}")
-                    skipped_count += 1
-                    continue
+                    if PROTECTED_RE and PROTECTED_RE.search(tag):
+                        LOGGER.info(" ✓ Keeping protected tag: %s - pattern match", tag)
+                        continue
+
+                    # Skip special tags
+                    if tag in SPECIAL_TAGS:
+                        LOGGER.info("  ⊘ Skipping special tag: %s", tag)
+                        skipped_count += 1
                 
-                # Calculate the age of the image
-                age_days = (datetime.now() - created_date).days
+                expired = {}
+                kept_digests = set()
+                unchecked_tags = []
                 
-                if created_date < cutoff_date:
-                    print(f"  × Deleting tag: {tag} (created: {created_date.strftime('%Y-%m-%d %H:%M')}, age: {age_days} days)")
-                    if delete_tag(repo, digest):
-                        deleted_count += 1
-                        print(f"    ✓ Successfully deleted")
+                for tag, future in zip(candidates, results):
+                    digest, created_date, etag = future.result()
+                    if digest is None:
+                        LOGGER.info("  ! Skipping tag (not found): %s", tag)
+                        skipped_count += 1
+                        continue
+                    
+                    if created_date is None:
+                        LOGGER.info("  ! Skipping tag (no date info): %s", tag)
+                        kept_digests.add(digest)
+                        skipped_count += 1
+                        continue
+                    
+                    # Calculate the age of the image
+                    age_days = (now - created_date).days
+                    
+                    if created_date < cutoff_date:
+                        expired.setdefault(digest, []).append((tag, created_date))
                     else:
-                        print(f"    × Failed to delete")
-                else:
-                    print(f"  ✓ Keeping recent tag: {tag} (created: {created_date.strftime('%Y-%m-%d %H:%M')}, age: {age_days} days)")
+                        cached = tag_cache.get((repo, tag))
+                        if cached and cached[1] >= cutoff_date:
+                            # Kept from the cache without asking the registry, so
+                            # the tag may have moved to another image since
+                            unchecked_tags.append(tag)
+                        else:
+                            kept_digests.add(digest)
+                        seen_tags[(repo, tag)] = (digest, created_date, etag)
+                        LOGGER.info("  ✓ Keeping recent tag: %s (created: %s, age: %s days)", tag, created_date.strftime(DATE_FORMAT), age_days)
+                
+                if expired:
+                    # Deleting a manifest removes every tag pointing at it, so
+                    # spare images that a kept tag still references
+                    try:
+                        kept_digests.update(executor.map(lambda tag: _tag_digest(repo, tag), skipped_tags + unchecked_tags))
+                        kept_digests.discard(None)
+                        # A kept manifest list also needs its per-platform manifests
+                        for children in list(executor.map(lambda digest: _manifest_children(repo, digest), list(kept_digests))):
+                            kept_digests.update(children)
+                    except requests.RequestException as exc:
+                        if AUTH_REJECTED.is_set():
+                            raise
+                        LOGGER.error("  ! Not deleting from %s: unable to check the images of kept tags: %s", repo, exc)
+                        skipped_count += sum(len(expired_tags) for expired_tags in expired.values())
+                        continue
+                    
+                    for digest, expired_tags in expired.items():
+                        digest_tags = [tag for tag, _ in expired_tags]
+                        if digest in kept_digests:
+                            LOGGER.info("  ⊘ Not deleting %s: image is shared with a kept tag", ', '.join(digest_tags))
+                            skipped_count += len(digest_tags)
+                            continue
+                        
+                        for tag, created_date in expired_tags:
+                            LOGGER.info("  × Deleting tag: %s (created: %s, age: %s days)", tag, created_date.strftime(DATE_FORMAT), (now - created_date).days)
+                        
+                        if not pending_deletes:
+                            before_future.result()
+                        # Delete each image once, and start now so it overlaps
+                        # with scanning the next repository
+                        pending_deletes.append((repo, digest_tags, executor.submit(delete_tag, repo, digest)))
+            
+            before_usage = before_future.result()
+            if before_usage is not None:
+                LOGGER.info("\nRegistry storage size before cleanup: %s (%s bytes)", format_size(before_usage), before_usage)
+            else:
+                LOGGER.info("\nRegistry storage size before cleanup: unavailable")
+            
+            if pending_deletes:
+                LOGGER.info("\nWaiting for %s deletions...", len(pending_deletes))
+                
+                for repo, digest_tags, future in pending_deletes:
+                    deleted = future.result()
+                    for tag in digest_tags:
+                        if deleted:
+                            deleted_count += 1
+                            LOGGER.info("  ✓ Successfully deleted: %s:%s", repo, tag)
+                        else:
+                            LOGGER.info("  × Failed to delete: %s:%s", repo, tag)
+        
+        save_tag_cache(seen_tags)
         
-        print(f"\n{'='*50}")
-        print(f"Total tags deleted: {deleted_count}")
-        print(f"Total tags skipped: {skipped_count}")
-        print(f"{'='*50}\n")
+        LOGGER.info("\n%s", SEPARATOR)
+        LOGGER.info("Total tags deleted: %s", deleted_count)
+        LOGGER.info("Total tags skipped: %s", skipped_count)
+        LOGGER.info("%s\n", SEPARATOR)
         
         if deleted_count > 0:
-            print("Running garbage collection...")
+            LOGGER.info("Running garbage collection...")
             if run_garbage_collection_docker():
-                print("✓ Garbage collection completed successfully")
+                LOGGER.info("✓ Garbage collection completed successfully")
             else:
-                print("× Garbage collection failed")
+                LOGGER.info("× Garbage collection failed")
         else:
-            print("No tags deleted, skipping garbage collection")
+            LOGGER.info("No tags deleted, skipping garbage collection")
             
-    except Exception as e:
+    except Exception:
         LOGGER.exception("Unhandled error during cleanup")
-        print(f"Error: {e}")
-        import traceback
-        traceback.print_exc()
         sys.exit(1)
     finally:
-        print(f"\n{'='*50}")
-        print("POST-CLEANUP STORAGE MEASUREMENT")
-        print(f"{'='*50}")
+        LOGGER.info("\n%s", SEPARATOR)
+        LOGGER.info("POST-CLEANUP STORAGE MEASUREMENT")
+        LOGGER.info("%s", SEPARATOR)
         
+        before_usage = before_future.result()
         if deleted_count > 0:
-            print("Waiting for filesystem sync...")
+            LOGGER.info("Waiting for filesystem sync...")
             try:
                 subprocess.run(
                     ['docker', 'exec', REGISTRY_CONTAINER, 'sync'],
@@ -441,23 +813,24 @@ def main():
         after_usage = get_registry_disk_usage()
         
         if after_usage is not None:
-            print(f"Registry storage size after cleanup: {format_size(after_usage)} ({after_usage} bytes)")
+            LOGGER.info("Registry storage size after cleanup: %s (%s bytes)", format_size(after_usage), after_usage)
             if before_usage is not None:
                 diff = before_usage - after_usage
                 if diff > 0:
                     percent = (diff / before_usage) * 100
-                    print(f"✓ Freed space: {format_size(diff)} ({diff} bytes, {percent:.2f}%)")
+                    LOGGER.info("✓ Freed space: %s (%s bytes, %.2f%%)", format_size(diff), diff, percent)
                 elif diff < 0:
                     diff_abs = abs(diff)
-                    print(f"⚠ Storage increased: {format_size(diff_abs)} ({diff_abs} bytes)")
+                    LOGGER.info("⚠ Storage increased: %s (%s bytes)", format_size(diff_abs), diff_abs)
                 else:
-                    print("No space freed (0 bytes)")
+                    LOGGER.info("No space freed (0 bytes)")
             else:
-                print("Cannot calculate freed space (initial size unavailable)")
+                LOGGER.info("Cannot calculate freed space (initial size unavailable)")
         else:
-            print("Registry storage size after cleanup: unavailable")
+            LOGGER.info("Registry storage size after cleanup: unavailable")
         
-        print(f"{'='*50}\n")
+        LOGGER.info("%s\n", SEPARATOR)
+        SESSION.close()
 
 
 if __name__ == '__main__':